@@ -1,8 +1,6 @@
 import numpy as np
-from surpyval.parametric import Parametric
-from surpyval.nonparametric import NonParametric
 
-from scipy.integrate import quad
+from scipy.integrate import quad, trapezoid
 from scipy.optimize import minimize
 
 class NonRepairable():
@@ -10,6 +8,10 @@ class NonRepairable():
     Class to store the non-repairable information
     """
     def __init__(self, distribution):
+        # surpyval is slow to import so it is only loaded here
+        from surpyval.parametric import Parametric
+        from surpyval.nonparametric import NonParametric
+
         self.dist = distribution
         if type(distribution) == Parametric:
             self.model_parameterization = 'parametric'
@@ -18,9 +20,6 @@ class NonRepairable():
         else:
             raise ValueError("Unknown TTF Model")
 
-        self.cost_rate = np.vectorize(self._cost_rate)
-        self.cost_rate_single_cycle = np.vectorize(self._cost_rate_single_cycle)
-
     def set_costs_planned_and_unplanned(self, cp, cu):
         assert cp < cu
         self.cp = cp
@@ -31,13 +30,50 @@ class NonRepairable():
         return out[0]
 
     def avg_replacement_time_non_parametric(self, t, interp):
+        if interp == 'linear':
+            # Piecewise linear from R(0) = 1 through the failure times
+            x = self.dist.x
+            keep = x > 0
+            x_knots = np.concatenate(([0.], x[keep]))
+            R_knots = np.concatenate(([1.], self.dist.R[keep]))
+            knots = np.concatenate(([0.], x[keep & (x < t)], [t]))
+            R = np.interp(knots, x_knots, R_knots, right=np.nan)
+            return trapezoid(R, knots)
         func = lambda x : self.dist.sf(x, interp=interp)
         out = quad(func, 0, t, limit=200)
         return out[0]
 
+    def _cumulative_quad(self, func, t):
+        # Integral of func from 0 to each value of t
+        order = np.argsort(t)
+        t_sorted = t[order]
+        lower = np.concatenate(([0.], t_sorted[:-1]))
+        pieces = [quad(func, a, b)[0] for a, b in zip(lower, t_sorted)]
+        out = np.empty_like(t_sorted)
+        out[order] = np.cumsum(pieces)
+        return out
+
+    def cost_rate(self, t):
+        t = np.asarray(t, dtype=float)
+        t_flat = t.ravel()
+        R = self.dist.sf(t_flat)
+        planned_costs = R * self.cp
+        unplanned_costs = (1 - R) * self.cu
+        avg_repl_time = self._cumulative_quad(self.dist.sf, t_flat)
+        return ((planned_costs + unplanned_costs) / avg_repl_time).reshape(t.shape)
+
+    def cost_rate_single_cycle(self, t):
+        t = np.asarray(t, dtype=float)
+        t_flat = t.ravel()
+        planned_costs = self.dist.sf(t_flat) * self.cp / t_flat
+        f = lambda x : self.dist.df(x) / x
+        unplanned_costs = self.cu * self._cumulative_quad(f, t_flat)
+        return (planned_costs + unplanned_costs).reshape(t.shape)
+
     def _cost_rate(self, t):
-        planned_costs = self.dist.sf(t) * self.cp
-        unplanned_costs = (1 - self.dist.sf(t)) * self.cu
+        R = self.dist.sf(t)
+        planned_costs = R * self.cp
+        unplanned_costs = (1 - R) * self.cu
         avg_repl_time = self.avg_replacement_time(t)
         return (planned_costs + unplanned_costs) / avg_repl_time
 
@@ -72,7 +108,9 @@ class NonRepairable():
         
             init = self.dist.mean()
             bounds = ((1e-8, None),)
-            res = minimize(self._log_cost_rate, init, bounds=bounds, tol=1e-10)
+            # minimize passes a length 1 array
+            func = lambda x : self._log_cost_rate(x[0])
+            res = minimize(func, init, bounds=bounds, tol=1e-10)
             self.optimisation_results = res
             return res.x[0]
         else:
@@ -80,14 +118,18 @@ class NonRepairable():
                 raise ValueError("When using Non-Parametric model must select interpolation method.")
             elif interp == 'step':
                 x = self.dist.x
-                RUL = (np.diff(x, prepend=0) * self.dist.sf(x)).cumsum()
-                cput = (self.cp * self.dist.sf(x) + self.cu * self.dist.ff(x)) / RUL
+                R = self.dist.sf(x)
+                RUL = (np.diff(x, prepend=0) * R).cumsum()
+                cput = (self.cp * R + self.cu * (1 - R)) / RUL
                 self.cput = cput
                 return x[np.argmin(cput)]
             elif interp == 'linear':
-                init = self.dist.x.mean()
+                # The cost rate can have several local minima, so start from
+                # the failure time with the lowest cost rate
+                cost = [self._cost_rate_non_parametric(t, interp) for t in self.dist.x]
+                init = self.dist.x[np.nanargmin(cost)]
                 bounds = ((self.dist.x.min(), self.dist.x.max()),)
-                func = lambda x : self._cost_rate_non_parametric(x, interp)
+                func = lambda x : self._cost_rate_non_parametric(x[0], interp)
                 res = minimize(func, init, bounds=bounds, tol=1e-10)
                 self.optimisation_results = res
                 return res.x[0]
@@ -102,6 +144,7 @@ class NonRepairable():
                 return np.inf
         init = self.dist.mean()
         bounds = ((1e-8, None),)
-        res = minimize(self._log_cost_rate_single_cycle, init, bounds=bounds, tol=1e-10)
+        func = lambda x : self._log_cost_rate_single_cycle(x[0])
+        res = minimize(func, init, bounds=bounds, tol=1e-10)
         self.optimisation_results = res
         return res.x[0]
\ No newline at end of file
@@ -1,26 +1,32 @@
 import numpy as np
 import networkx as nx
-from collections import defaultdict
 from copy import copy
-import surpyval as surv
 
 class PerfectReliability:
     @classmethod
     def sf(cls, x):
-        return np.ones_like(x).astype(float)
+        return np.ones_like(x, dtype=float)
 
     @classmethod
     def ff(cls, x):
-        return np.zeros_like(x).astype(float)
+        return np.zeros_like(x, dtype=float)
+
+    @classmethod
+    def Hf(cls, x):
+        return np.zeros_like(x, dtype=float)
 
 class PerfectUnreliability:
     @classmethod
     def sf(cls, x):
-        return np.zeros_like(x).astype(float)
+        return np.zeros_like(x, dtype=float)
 
     @classmethod
     def ff(cls, x):
-        return np.ones_like(x).astype(float)
+        return np.ones_like(x, dtype=float)
+
+    @classmethod
+    def Hf(cls, x):
+        return np.full_like(x, np.inf, dtype=float)
 
 class ExactFailureTimeModel:
 
@@ -32,6 +38,10 @@ class ExactFailureTimeModel:
         x = np.atleast_1d(x)
         return (x >= self.T).astype(float)
 
+    def Hf(self, x):
+        x = np.atleast_1d(x)
+        return np.where(x < self.T, 0., np.inf)
+
 class ExactFailureTime:
 
     @classmethod
@@ -40,6 +50,20 @@ class ExactFailureTime:
         out.T = T
         return out
 
+def _log_sf(model, x):
+    # -Hf(x) is log(sf(x)) except for zero-inflated surpyval models, whose
+    # Hf does not include the f0 term
+    if hasattr(model, 'Hf') and getattr(model, 'f0', 0) == 0:
+        return -model.Hf(x)
+    return np.log(model.sf(x))
+
+def _one_minus_exp(x):
+    # 1 - exp(x), giving 0. rather than -0. where x is 0
+    return 0. - np.expm1(x)
+
+# Number of floats gathered at once when evaluating many node scenarios
+_SCENARIO_BUFFER_SIZE = 2 ** 20
+
 class RBD:
     # TODO: Implement these
     # Finding cut-sets:
@@ -78,7 +102,10 @@ class RBD:
         new_models = {}
         for k, v in components.items():
             if type(v) == list:
-                sim = 0
+                # Only needed to fit the summed lifetimes
+                import surpyval as surv
+
+                sim = np.zeros(mc_samples)
                 for model in v:
                     sim += model.random(mc_samples)
 
@@ -90,17 +117,83 @@ class RBD:
 
         self.components = components
         self.nodes = nodes
+        self._path_cache_key = None
 
     def all_path_sets(self):
         # For a very large RBD, this seems expensive; O(n!).....
         # Need to convert to a fault tree using graph algs
         return nx.all_simple_paths(self.G, source=self.input_node, target=self.output_node)
 
-    def sf(self, x, working_nodes=None, broken_nodes=None,
-           working_components=None, broken_components=None):
-        
+    def _path_indices(self):
+        # Indices (into self.nodes) of the nodes on every path, flattened,
+        # with the start and length of each path. Cached until the graph or
+        # the nodes change.
+        key = (frozenset(self.G.edges), tuple(self.nodes.keys()))
+        if key == self._path_cache_key:
+            return self._path_cache
+
         if not self.check_rbd_structure():
             raise ValueError("RBD not correctly structured, add edges or nodes to create correct structure.")
+
+        node_index = {node: i for i, node in enumerate(self.nodes.keys())}
+        node_idx = []
+        path_len = []
+        for path in self.all_path_sets():
+            path_nodes = [node_index[node] for node in path if node not in self.in_or_out]
+            node_idx.extend(path_nodes)
+            path_len.append(len(path_nodes))
+
+        path_len = np.array(path_len, dtype=int)
+        path_start = np.cumsum(path_len) - path_len
+        self._path_cache = (np.array(node_idx, dtype=int), path_start, path_len)
+        self._path_cache_key = key
+        return self._path_cache
+
+    def _node_log_sf(self, x, working_components=(), broken_components=()):
+        # Log reliability of the component at each node, one row per node
+        # in the order of self.nodes.
+        overrides = {component: PerfectUnreliability for component in broken_components}
+        overrides.update({component: PerfectReliability for component in working_components})
+        component_index = {}
+        component_log_r = np.empty((len(self.components),) + x.shape)
+        for i, (component, model) in enumerate(self.components.items()):
+            component_index[component] = i
+            component_log_r[i] = _log_sf(overrides.get(component, model), x)
+
+        node_component = [component_index[c] for c in self.nodes.values()]
+        return component_log_r[np.array(node_component, dtype=int)]
+
+    def _path_log_sf(self, node_log_r):
+        # Log reliability of every path. The first axis of node_log_r is the
+        # node, any trailing axes are carried through. Paths with no nodes
+        # are left at 0.
+        node_idx, path_start, path_len = self._path_indices()
+        path_rel = np.zeros((len(path_len),) + node_log_r.shape[1:])
+        has_nodes = path_len > 0
+        if np.any(has_nodes):
+            path_rel[has_nodes] = np.add.reduceat(node_log_r[node_idx], path_start[has_nodes], axis=0)
+        return path_rel
+
+    def _system_log_ff_from_paths(self, path_rel):
+        # Log of the system unreliability, the sum of the log unreliability
+        # of every path. Overwrites path_rel.
+        paths_ff = np.expm1(path_rel, out=path_rel)
+        np.negative(paths_ff, out=paths_ff)
+        # Paths that cannot fail give log(0) = -inf
+        with np.errstate(divide='ignore'):
+            np.log(paths_ff, out=paths_ff)
+        # return np.prod(paths_ff, axis=0)
+        # Is this really needed?
+        return np.sum(paths_ff, axis=0)
+
+    def _system_log_ff(self, node_log_r):
+        return self._system_log_ff_from_paths(self._path_log_sf(node_log_r))
+
+    def _system_sf(self, node_log_r):
+        return _one_minus_exp(self._system_log_ff(node_log_r))
+
+    def sf(self, x, working_nodes=None, broken_nodes=None,
+           working_components=None, broken_components=None):
         if working_nodes is None:
             working_nodes = []
         if broken_nodes is None:
@@ -111,48 +204,24 @@ class RBD:
             broken_components = []
 
         x = np.atleast_1d(x)
-        r_dict = {}
-        for component in self.components.keys():
-            if component in working_components:
-                r_dict[component] = np.log(PerfectReliability.sf(x))
-            elif component in broken_components:
-                r_dict[component] = np.log(PerfectUnreliability.sf(x))
-            else:
-                r_dict[component] = np.log(self.components[component].sf(x))
-
-        paths = self.all_path_sets()
-        paths_reliabililty = []
-        for path in paths:
-            path_rel = np.zeros_like(x).astype(float)
-            for node in path:
-                if node in self.in_or_out:
-                    continue
-                if node in working_nodes:
-                    path_rel += np.log(PerfectReliability.sf(x))
-                elif node in broken_nodes:
-                    path_rel += np.log(PerfectUnreliability.sf(x))
-                else:
-                    path_rel += r_dict[self.nodes[node]]
-            paths_reliabililty.append(np.exp(path_rel))
-        paths_ff = 1 - np.atleast_2d(paths_reliabililty)
-        # return 1 - np.prod(paths_ff, axis=0)
-        # Is this really needed?
-        return 1 - np.exp(np.sum(np.log(paths_ff), axis=0))
+        node_log_r = self._node_log_sf(x, working_components, broken_components)
+        overrides = {node: PerfectUnreliability for node in broken_nodes}
+        overrides.update({node: PerfectReliability for node in working_nodes})
+        for i, node in enumerate(self.nodes.keys()):
+            if node in overrides:
+                node_log_r[i] = _log_sf(overrides[node], x)
+
+        return self._system_sf(node_log_r)
 
     def ff(self, x):
-        return 1 - self.sf(x)
+        x = np.atleast_1d(x)
+        return np.exp(self._system_log_ff(self._node_log_sf(x)))
 
     def check_rbd_structure(self):
         has_circular_dependency = not nx.is_directed_acyclic_graph(self.G)
-        node_degrees = defaultdict(lambda: defaultdict(int))
 
-        for edge in self.G.edges:
-            source, target = edge
-            node_degrees[source]['out'] += 1
-            node_degrees[target]['in'] += 1
-
-        input_nodes = [n for k, n in node_degrees.items() if n['in'] == 0]
-        output_nodes = [n for k, n in node_degrees.items() if n['out'] == 0]
+        input_nodes = [n for n, d in self.G.in_degree() if d == 0]
+        output_nodes = [n for n, d in self.G.out_degree() if d == 0]
         has_node_with_no_input = len(input_nodes) != 1
         has_node_with_no_output = len(output_nodes) != 1
         if not any([has_circular_dependency,
@@ -169,48 +238,84 @@ class RBD:
             }
             return False
 
+    def _log_ff_each_node_set_to(self, node_log_r, log_r):
+        # System log unreliability with each node in turn set to log_r (0 for
+        # working, -inf for broken), one row per node, evaluated in chunks of
+        # nodes to bound memory.
+        n = len(self.nodes)
+        node_idx, _, _ = self._path_indices()
+        per_scenario = max(len(node_idx), 1) * max(node_log_r[0].size, 1)
+        chunk = max(_SCENARIO_BUFFER_SIZE // per_scenario, 1)
+
+        log_ff = np.empty((n,) + node_log_r.shape[1:])
+        for start in range(0, n, chunk):
+            stop = min(start + chunk, n)
+            diag = np.arange(start, stop)
+            scenarios = np.repeat(node_log_r[:, np.newaxis], stop - start, axis=1)
+            scenarios[diag, diag - start] = log_r
+            log_ff[start:stop] = self._system_log_ff(scenarios)
+        return log_ff
+
     # Importance measures
     # https://www.ntnu.edu/documents/624876/1277590549/chapt05.pdf/82cd565f-fa2f-43e4-a81a-095d95d39272
+    def _birnbaum(self, node_log_r):
+        working = self._log_ff_each_node_set_to(node_log_r, 0.)
+        failing = self._log_ff_each_node_set_to(node_log_r, -np.inf)
+        return np.exp(failing) - np.exp(working)
+
     def birnbaum_importance(self, x):
+        x = np.atleast_1d(x)
+        I_B = self._birnbaum(self._node_log_sf(x))
+
         node_importance = {}
-        for node in self.nodes.keys():
-            working = self.sf(x, working_nodes=[node])
-            failing = self.sf(x, broken_nodes=[node])
-            node_importance[node] = working - failing
+        for i, node in enumerate(self.nodes.keys()):
+            node_importance[node] = I_B[i]
         return node_importance
 
     # TODO: update all importance measures to allow for component as well
     def improvement_potential(self, x):
+        x = np.atleast_1d(x)
+        node_log_r = self._node_log_sf(x)
+        as_is = self._system_log_ff(node_log_r)
+        working = self._log_ff_each_node_set_to(node_log_r, 0.)
+
         node_importance = {}
-        for node in self.nodes.keys():
-            working = self.sf(x, working_nodes=[node])
-            as_is = self.sf(x)
-            node_importance[node] = working - as_is
+        for i, node in enumerate(self.nodes.keys()):
+            node_importance[node] = np.exp(as_is) - np.exp(working[i])
         return node_importance
 
     def risk_achievement_worth(self, x):
+        x = np.atleast_1d(x)
+        node_log_r = self._node_log_sf(x)
+        as_is = self._system_log_ff(node_log_r)
+        failing = self._log_ff_each_node_set_to(node_log_r, -np.inf)
+
         node_importance = {}
-        for node in self.nodes.keys():
-            failing = self.sf(x, broken_nodes=[node])
-            as_is = self.sf(x)
-            node_importance[node] = ((1 - failing) / (1 - as_is)) - 1
+        for i, node in enumerate(self.nodes.keys()):
+            node_importance[node] = np.expm1(failing[i] - as_is)
         return node_importance
 
     def risk_reduction_worth(self, x):
+        x = np.atleast_1d(x)
+        node_log_r = self._node_log_sf(x)
+        as_is = self._system_log_ff(node_log_r)
+        working = self._log_ff_each_node_set_to(node_log_r, 0.)
+
         node_importance = {}
-        for node in self.nodes.keys():
-            working = self.sf(x, working_nodes=[node])
-            as_is = self.sf(x)
-            node_importance[node] = ((1 - as_is) / (1 - working)) - 1
+        for i, node in enumerate(self.nodes.keys()):
+            node_importance[node] = np.expm1(as_is - working[i])
         return node_importance
 
     def criticality_importance(self, x):
-        I_B = self.birnbaum_importance(x)
+        x = np.atleast_1d(x)
+        node_log_r = self._node_log_sf(x)
+        as_is = self._system_log_ff(node_log_r)
+        I_B = self._birnbaum(node_log_r)
+        node_ff = _one_minus_exp(node_log_r)
+
         node_importance = {}
-        for node in self.nodes.keys():
-            as_is = self.sf(x)
-            node_ff = self.components[self.nodes[node]].ff(x)
-            node_importance[node] = I_B[node] * node_ff / (1 - as_is)
+        for i, node in enumerate(self.nodes.keys()):
+            node_importance[node] = I_B[i] * node_ff[i] / np.exp(as_is)
         return node_importance
 
     def fussel_vessely(self, x, fv_type='p'):
@@ -221,33 +326,21 @@ class RBD:
         if fv_type == 'c':
             raise NotImplementedError("cut set type FV importance measure not yet implemented")
 
-        system_reliability  = self.sf(x)
+        x = np.atleast_1d(x)
+        node_log_r = self._node_log_sf(x)
+        node_idx, path_start, path_len = self._path_indices()
+        path_rel = self._path_log_sf(node_log_r)
+        path_idx = np.repeat(np.arange(len(path_len)), path_len)
+
+        # Combined log reliability of the paths through each node
+        node_paths_rel = np.zeros((len(self.nodes),) + x.shape)
+        np.add.at(node_paths_rel, node_idx, path_rel[path_idx])
+
+        system_reliability = _one_minus_exp(self._system_log_ff_from_paths(path_rel))
+        paths_sf = _one_minus_exp(node_paths_rel) / system_reliability
 
-        paths = list(self.all_path_sets())
         node_importance = {}
+        for i, node in enumerate(self.nodes.keys()):
+            node_importance[node] = paths_sf[i]
 
-        x = np.atleast_1d(x)
-        r_dict = {}
-        for component in self.components.keys():
-            r_dict[component] = np.log(self.components[component].sf(x))
-
-        for node in self.nodes.keys():
-            paths_reliabililty = []
-            for path in paths:
-                if node in self.in_or_out:
-                    continue
-                elif node not in path:
-                    continue
-                path_rel = np.zeros_like(x).astype(float)
-                for n in path:
-                    if n in self.in_or_out:
-                        continue
-                    path_rel += r_dict[self.nodes[n]]
-                paths_reliabililty.append(path_rel)
-            
-            paths_sf = np.atleast_2d(paths_reliabililty)
-            paths_sf = 1 - np.exp(np.sum(paths_sf, axis=0))
-            paths_sf = paths_sf / system_reliability
-            node_importance[node] = np.copy(paths_sf)
-        
         return node_importance